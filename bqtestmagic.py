@@ -1,62 +1,257 @@
 import argparse
+import atexit
+import collections
+import functools
+import hashlib
 import sys
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 import pandas as pd
 from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
+from google.cloud.bigquery.table import RowIterator
 from IPython.core import magic_arguments
-from IPython.core.magic import Magics, cell_magic, magics_class
+from IPython.core.magic import Magics, cell_magic, line_magic, magics_class
+
+# Results below both limits are compared locally, which saves the job that
+# compares them in BigQuery.
+_CLIENT_SIDE_COMPARISON_MAX_BYTES = 10 * 1024 * 1024
+_CLIENT_SIDE_COMPARISON_MAX_ROWS = 10000
+
+_MATCH_CONDITION_TEMPLATE = textwrap.dedent(
+    """\
+      NOT EXISTS(
+      SELECT
+        *
+      FROM (
+        SELECT
+          FORMAT("%T", actual) AS json_string,
+          COUNT(*) AS count
+        FROM (
+    {left}
+        ) AS actual
+        GROUP BY
+          json_string) AS actual
+      FULL JOIN (
+        SELECT
+          FORMAT("%T", expected) AS json_string,
+          COUNT(*) AS count
+        FROM (
+    {right}
+        ) AS expected
+        GROUP BY
+          json_string) AS expected
+      USING
+        (json_string)
+      WHERE
+        (actual.count = expected.count) IS NOT TRUE
+      LIMIT
+        1 )"""
+)
+_MATCH_SQL_TEMPLATE = f"ASSERT\n{_MATCH_CONDITION_TEMPLATE}\n"
+_BATCH_MATCH_SQL_TEMPLATE = (
+    f"SELECT\n  {{i}} AS i,\n{_MATCH_CONDITION_TEMPLATE} AS equals"
+)
+
+
+# Re-running a cell builds the same SQL again. Only the SQL is cached, and the
+# query is still sent, as BigQuery knows whether the tables have changed.
+# The queries are embedded as they are, as re-indenting them would change the
+# contents of multi-line string literals.
+@functools.lru_cache(maxsize=32)
+def _match_sql(left: str, right: str) -> str:
+    return _MATCH_SQL_TEMPLATE.format_map(
+        {"left": left.rstrip(), "right": right.rstrip()}
+    )
+
+
+_clients: Dict[Optional[str], bigquery.Client] = {}
+_bqstorage_clients: Dict[Optional[str], Any] = {}
+
+
+def _get_client(project: Optional[str]) -> bigquery.Client:
+    # Creating a client looks up credentials and opens a new connection, so reuse
+    # it across cells.
+    if project not in _clients:
+        _clients[project] = bigquery.Client(project)
+    return _clients[project]
+
+
+def _get_bqstorage_client(project: Optional[str]) -> Any:
+    # Older versions do not have `_ensure_bqstorage_client`. It returns None if
+    # google-cloud-bigquery-storage is not installed, and results are then
+    # downloaded with the REST API.
+    if project not in _bqstorage_clients:
+        ensure_bqstorage_client = getattr(
+            _get_client(project), "_ensure_bqstorage_client", None
+        )
+        _bqstorage_clients[project] = (
+            ensure_bqstorage_client() if ensure_bqstorage_client else None
+        )
+    return _bqstorage_clients[project]
+
+
+@atexit.register
+def _close_clients():
+    for bqstorage_client in _bqstorage_clients.values():
+        if bqstorage_client is not None:
+            bqstorage_client._transport.grpc_channel.close()
+    _bqstorage_clients.clear()
+    for client in _clients.values():
+        # Older versions do not have `close`
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+    _clients.clear()
+
+
+# Key that tells values apart as FORMAT("%T", ...) does. Field names of structs are
+# ignored, while types with the same Python type (e.g. NUMERIC and BIGNUMERIC, or
+# STRING and GEOGRAPHY) are not equal.
+def _comparison_key(value: Any, field: bigquery.SchemaField) -> Any:
+    if field.mode == "REPEATED":
+        return tuple(_element_comparison_key(element, field) for element in value)
+    return _element_comparison_key(value, field)
+
+
+def _element_comparison_key(value: Any, field: bigquery.SchemaField) -> Any:
+    if value is None:
+        return None
+    if field.field_type in ("RECORD", "STRUCT"):
+        return tuple(
+            _comparison_key(value[subfield.name], subfield) for subfield in field.fields
+        )
+    # JSON values may be unhashable dicts and lists.
+    return field.field_type, repr(value)
+
+
+def _count_rows(row_iterator: RowIterator) -> Optional[collections.Counter]:
+    rows = list(row_iterator)
+    if len(rows) > _CLIENT_SIDE_COMPARISON_MAX_ROWS:
+        return None
+    return collections.Counter(
+        tuple(
+            _comparison_key(value, field)
+            for value, field in zip(row.values(), row_iterator.schema)
+        )
+        for row in rows
+    )
+
+
+# The modification time and the size are part of the key, so that edited files are
+# read again. The path must be resolved, as a relative one depends on the working
+# directory.
+@functools.lru_cache(maxsize=32)
+def _read_sql_file(sql_file: Path, mtime_ns: int, size: int) -> str:
+    return sql_file.read_text(encoding="utf-8")
+
+
+def _read_csv(csv_file: Path, like: pd.DataFrame) -> pd.DataFrame:
+    # Parse columns as the dtypes of the query results, so that e.g. a STRING column
+    # of digits is not inferred as integers. Datetimes cannot be parsed this way.
+    dtype = {
+        column: dtype
+        for column, dtype in like.dtypes.items()
+        if not pd.api.types.is_datetime64_any_dtype(dtype)
+    }
+    try:
+        return pd.read_csv(csv_file, dtype=dtype)
+    except (NotImplementedError, TypeError, ValueError):
+        # The file does not match the dtypes, so leave them to inference.
+        return pd.read_csv(csv_file)
 
 
 class BigQueryTest:
+    # Statement types and bytes processed of SELECT statements by their digests
+    _dry_runs: Dict[bytes, Tuple[str, int]] = {}
+
     def __init__(self, project: Optional[str]):
-        self.client = bigquery.Client(project)
+        self.project = project
+        self.client = _get_client(project)
+        # Older versions do not have `query_and_wait`, which returns the first rows
+        # in the same request that runs the query.
+        self._query_and_wait = getattr(self.client, "query_and_wait", None)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc_info):
-        # Older versions do not have `close`
-        if hasattr(self.client, "close"):
-            self.client.close()
+        # Clients are shared across cells and closed at exit.
+        pass
 
-    def download_query_results_to_dataframe(self, sql: str, labels: Dict[str, str]):
-        return self.client.query(
-            sql, job_config=bigquery.QueryJobConfig(labels=labels)
-        ).to_dataframe()
+    def run_query(self, sql: str, labels: Dict[str, str]) -> bigquery.QueryJob:
+        return self.client.query(sql, job_config=bigquery.QueryJobConfig(labels=labels))
 
-    def query_to_check_that_two_query_results_match(
-        self, left: str, right: str, labels: Dict[str, str]
+    def run_query_and_wait(
+        self, sql: str, labels: Dict[str, str], max_results: Optional[int] = None
+    ) -> RowIterator:
+        job_config = bigquery.QueryJobConfig(labels=labels)
+        if self._query_and_wait is not None:
+            return self._query_and_wait(
+                sql, job_config=job_config, max_results=max_results
+            )
+        return self.client.query(sql, job_config=job_config).result(
+            max_results=max_results
+        )
+
+    def download_query_results_to_dataframe(
+        self, query_job: bigquery.QueryJob
+    ) -> pd.DataFrame:
+        return query_job.to_dataframe(
+            bqstorage_client=_get_bqstorage_client(self.project)
+        )
+
+    def query_to_select_query_results(self, query_job: bigquery.QueryJob) -> str:
+        # Read the table the results have been written to instead of running the
+        # query again. Scripts have no such table.
+        table = query_job.destination
+        if table is None:
+            return query_job.query
+        return f"SELECT * FROM `{table.project}.{table.dataset_id}.{table.table_id}`"
+
+    def query_to_check_that_query_results_match(
+        self,
+        expected_sql: str,
+        query_job: bigquery.QueryJob,
+        results: RowIterator,
+        labels: Dict[str, str],
     ) -> bool:
-        sql = textwrap.dedent(
-            f"""\
-            ASSERT
-              NOT EXISTS(
-              SELECT
-                *
-              FROM (
-                SELECT
-                  FORMAT("%T", actual) AS json_string,
-                  COUNT(*) AS count
-                FROM (\n{textwrap.indent(left.rstrip(), "                  ")} ) AS actual
-                GROUP BY
-                  json_string) AS actual
-              FULL JOIN (
-                SELECT
-                  FORMAT("%T", expected) AS json_string,
-                  COUNT(*) AS count
-                FROM (\n{textwrap.indent(right.rstrip(), "                  ")} ) AS expected
-                GROUP BY
-                  json_string) AS expected
-              USING
-                (json_string)
-              WHERE
-                (actual.count = expected.count) IS NOT TRUE )
-            """  # noqa: E501
+        # Small results are compared locally. The expected query runs once, and the
+        # rows of the finished query job are read without running it again.
+        _, total_bytes_processed = self.dry_run(expected_sql)
+        if (
+            query_job.destination is not None
+            and results.total_rows is not None
+            and results.total_rows <= _CLIENT_SIDE_COMPARISON_MAX_ROWS
+            and total_bytes_processed < _CLIENT_SIDE_COMPARISON_MAX_BYTES
+        ):
+            expected_rows = _count_rows(
+                self.run_query_and_wait(
+                    expected_sql,
+                    labels,
+                    max_results=_CLIENT_SIDE_COMPARISON_MAX_ROWS + 1,
+                )
+            )
+            if expected_rows is not None:
+                return expected_rows == _count_rows(results)
+        return self.assert_that_two_query_results_match(
+            expected_sql, self.query_to_select_query_results(query_job), labels
         )
+
+    def assert_that_two_query_results_match(
+        self, left: str, right: str, labels: Dict[str, str]
+    ) -> bool:
+        sql = _match_sql(left, right)
         query_job = self.client.query(
             sql, job_config=bigquery.QueryJobConfig(labels=labels)
         )
@@ -77,11 +272,46 @@ class BigQueryTest:
             raise e
         return True
 
-    def validate_query(self, query: str):
+    def query_to_check_that_pairs_of_query_results_match(
+        self, pairs: List[Tuple[str, str]], labels: Dict[str, str]
+    ) -> List[bool]:
+        sql = "\nUNION ALL\n".join(
+            _BATCH_MATCH_SQL_TEMPLATE.format_map(
+                {"i": i, "left": left.rstrip(), "right": right.rstrip()}
+            )
+            for i, (left, right) in enumerate(pairs)
+        )
+        equals = {
+            row["i"]: row["equals"] for row in self.run_query_and_wait(sql, labels)
+        }
+        return [equals[i] for i in range(len(pairs))]
+
+    def read_sql_file(self, sql_file: Path, reliable: bool) -> str:
+        sql_file = sql_file.resolve()
+        stat = sql_file.stat()
+        expected_sql = _read_sql_file(sql_file, stat.st_mtime_ns, stat.st_size)
+        # Do not use untrusted SQL, which can cause SQL injection!
+        if not reliable:
+            self.validate_query(expected_sql)
+        return expected_sql
+
+    def dry_run(self, query: str) -> Tuple[str, int]:
+        key = hashlib.blake2b(query.encode(), digest_size=16).digest()
+        if key in self._dry_runs:
+            return self._dry_runs[key]
+
         job_config = bigquery.QueryJobConfig(dry_run=True)
         query_job = self.client.query(query, job_config=job_config)
 
-        if query_job.statement_type != "SELECT":
+        result = (query_job.statement_type, query_job.total_bytes_processed or 0)
+        # Other statements fail validation, so they are dry-run again next time.
+        if query_job.statement_type == "SELECT":
+            self._dry_runs[key] = result
+        return result
+
+    def validate_query(self, query: str):
+        statement_type, _ = self.dry_run(query)
+        if statement_type != "SELECT":
             raise ValueError("Statement type must be SELECT")
 
     def test(
@@ -96,20 +326,26 @@ class BigQueryTest:
             raise ValueError("Please specify only sql_file or csv_file.")
 
         try:
-            actual = self.download_query_results_to_dataframe(query, labels)
+            query_job = self.run_query(query, labels)
+            # Wait here, so that only this thread polls the job. The download cannot
+            # start before the job is done anyway.
+            results = query_job.result()
+            # The download and the check are independent, so run them concurrently.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(
+                    self.download_query_results_to_dataframe, query_job
+                )
+                if sql_file:
+                    expected_sql = self.read_sql_file(sql_file, reliable)
+                    equals = self.query_to_check_that_query_results_match(
+                        expected_sql, query_job, results, labels
+                    )
+                actual = future.result()
 
             if sql_file:
-                with open(sql_file) as f:
-                    expected_sql = f.read()
-                # Do not use untrusted SQL, which can cause SQL injection!
-                if not reliable:
-                    self.validate_query(expected_sql)
-                equals = self.query_to_check_that_two_query_results_match(
-                    expected_sql, query, labels
-                )
                 print("✓" if equals else "✕")
             if csv_file:
-                expected_dataframe = pd.read_csv(csv_file)
+                expected_dataframe = _read_csv(csv_file, actual)
                 equals = expected_dataframe.equals(actual)
                 print("✓" if equals else "✕")
             return actual
@@ -118,6 +354,54 @@ class BigQueryTest:
             return None
 
 
+class BatchRunner:
+    def __init__(self):
+        # Tests to run in one job for each project and labels, with their positions
+        # in the queue
+        self.tests: DefaultDict[
+            Tuple[Optional[str], Tuple[Tuple[str, str], ...]],
+            List[Tuple[int, Path, str, str]],
+        ] = collections.defaultdict(list)
+        self.count = 0
+
+    def add(
+        self,
+        query: str,
+        sql_file: Path,
+        project: Optional[str],
+        reliable: bool,
+        labels: Dict[str, str],
+    ):
+        self.count += 1
+        try:
+            with BigQueryTest(project) as bqtest:
+                expected_sql = bqtest.read_sql_file(sql_file, reliable)
+        except Exception as ex:
+            print(f"ERROR:\n{ex}", file=sys.stderr)
+            return
+        key = (project, tuple(sorted(labels.items())))
+        self.tests[key].append((self.count, sql_file, expected_sql, query))
+
+    def run(self):
+        tests, self.tests = self.tests, collections.defaultdict(list)
+        self.count = 0
+        for (project, labels), group in tests.items():
+            try:
+                with BigQueryTest(project) as bqtest:
+                    results = bqtest.query_to_check_that_pairs_of_query_results_match(
+                        [(expected_sql, query) for _, _, expected_sql, query in group],
+                        dict(labels),
+                    )
+            except Exception as ex:
+                sql_files = ", ".join(
+                    f"[{i}] {sql_file}" for i, sql_file, _, _ in group
+                )
+                print(f"ERROR in {sql_files}:\n{ex}", file=sys.stderr)
+                continue
+            for (i, sql_file, _, _), equals in zip(group, results):
+                print(f"{'✓' if equals else '✕'} [{i}] {sql_file}")
+
+
 def label(string):
     if "=" not in string:
         raise argparse.ArgumentTypeError(f"{string} is not KEY=VALUE")
@@ -126,6 +410,11 @@ def label(string):
 
 @magics_class
 class SQLTestMagic(Magics):
+    def __init__(self, shell=None, **kwargs):
+        super().__init__(shell=shell, **kwargs)
+        # `%%sql_batch` cells waiting for `%sql_flush`
+        self.batch_runner = BatchRunner()
+
     @cell_magic
     @magic_arguments.magic_arguments()
     @magic_arguments.argument("target", type=str.lower, choices=["bigquery"])
@@ -143,9 +432,30 @@ class SQLTestMagic(Magics):
                 csv_file=args.csv_file,
                 sql_file=args.sql_file,
                 reliable=args.reliable,
-                labels={k: v for k, v in args.labels} if args.labels else {},
+                labels=dict(args.labels or ()),
             )
 
+    @cell_magic
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument("target", type=str.lower, choices=["bigquery"])
+    @magic_arguments.argument("--sql_file", type=Path, required=True)
+    @magic_arguments.argument("--project", type=str)
+    @magic_arguments.argument("--reliable", action="store_true")
+    @magic_arguments.argument("--labels", type=label, metavar="KEY=VALUE", nargs="*")
+    def sql_batch(self, line: str, query: str):
+        args: argparse.Namespace = magic_arguments.parse_argstring(self.sql_batch, line)
+        self.batch_runner.add(
+            query=query,
+            sql_file=args.sql_file,
+            project=args.project,
+            reliable=args.reliable,
+            labels=dict(args.labels or ()),
+        )
+
+    @line_magic
+    def sql_flush(self, line: str):
+        self.batch_runner.run()
+
 
 def load_ipython_extension(ipython):
     ipython.register_magics(SQLTestMagic)
@@ -2,16 +2,42 @@ import argparse
 import os
 import tempfile
 import textwrap
+import threading
+from collections import Counter
+from decimal import Decimal
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 import pytest
 from google.api_core.exceptions import BadRequest
+from google.cloud.bigquery import Row, SchemaField, TableReference
 from IPython.core.error import UsageError
 from pytest_mock.plugin import MockerFixture
 
-from bqtestmagic import BigQueryTest, SQLTestMagic, label
+import bqtestmagic
+from bqtestmagic import (
+    BatchRunner,
+    BigQueryTest,
+    SQLTestMagic,
+    _count_rows,
+    _read_csv,
+    _read_sql_file,
+    label,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_clients():
+    bqtestmagic._clients.clear()
+    bqtestmagic._bqstorage_clients.clear()
+    BigQueryTest._dry_runs.clear()
+    bqtestmagic._read_sql_file.cache_clear()
+    bqtestmagic._match_sql.cache_clear()
+    yield
+    bqtestmagic._clients.clear()
+    bqtestmagic._bqstorage_clients.clear()
+    BigQueryTest._dry_runs.clear()
 
 
 class TestSQLTestMagic:
@@ -74,15 +100,65 @@ class TestSQLTestMagic:
             labels=labels,
         )
 
+    def test_reuse_argument_parser(self, mocker: MockerFixture, bqtest: SQLTestMagic):
+        construct_parser = mocker.patch("IPython.core.magic_arguments.construct_parser")
+        mocker.patch("google.cloud.bigquery.Client")
+        mocker.patch("bqtestmagic.BigQueryTest.test")
+        bqtest.sql("BigQuery --project=my-project", "SELECT 1 col1")
+
+        construct_parser.assert_not_called()
+
+    def test_queue_sql_batch_until_sql_flush(
+        self, mocker: MockerFixture, bqtest: SQLTestMagic
+    ):
+        add = mocker.patch("bqtestmagic.BatchRunner.add")
+        run = mocker.patch("bqtestmagic.BatchRunner.run")
+        bqtest.sql_batch(
+            "BigQuery --sql_file=b.sql --project=my-project --labels a=b",
+            "SELECT 1 col1",
+        )
+
+        add.assert_called_once_with(
+            query="SELECT 1 col1",
+            sql_file=Path("b.sql"),
+            project="my-project",
+            reliable=False,
+            labels={"a": "b"},
+        )
+        run.assert_not_called()
+        bqtest.sql_flush("")
+        run.assert_called_once_with()
+
+    def test_raise_error_if_sql_batch_has_no_sql_file(self, bqtest: SQLTestMagic):
+        with pytest.raises(UsageError):
+            bqtest.sql_batch("BigQuery", "SELECT 1 col1")
+
     class TestClose:
-        def test_close_bigquery_client_if_it_has_close_attribute(
+        def test_reuse_bigquery_client_across_cells(
+            self, mocker: MockerFixture, bqtest: SQLTestMagic
+        ):
+            client = mocker.patch("google.cloud.bigquery.Client")
+            mocker.patch("bqtestmagic.BigQueryTest.test")
+            bqtest.sql("BigQuery --project=my-project", "SELECT 1 col1")
+            bqtest.sql("BigQuery --project=my-project", "SELECT 1 col1")
+            bqtest.sql("BigQuery --project=other-project", "SELECT 1 col1")
+
+            assert client.call_args_list == [
+                mocker.call("my-project"),
+                mocker.call("other-project"),
+            ]
+            client.return_value.close.assert_not_called()
+
+        def test_close_bigquery_client_at_exit_if_it_has_close_attribute(
             self, mocker: MockerFixture, bqtest: SQLTestMagic
         ):
             client = mocker.Mock(spec=["close"])
             mocker.patch("google.cloud.bigquery.Client", return_value=client)
             bqtest.sql("BigQuery", "SELECT 1 col1")
+            bqtestmagic._close_clients()
 
             client.close.assert_called_once_with()
+            assert bqtestmagic._clients == {}
 
         def test_no_close_if_bigquery_client_does_not_have_close_attribute(
             self, mocker: MockerFixture, bqtest: SQLTestMagic
@@ -90,10 +166,102 @@ class TestSQLTestMagic:
             client = mocker.Mock(spec=[])
             mocker.patch("google.cloud.bigquery.Client", return_value=client)
             bqtest.sql("BigQuery", "SELECT 1 col1")
+            bqtestmagic._close_clients()
 
             assert hasattr(client, "close") is False
 
 
+class TestBatchRunner:
+    @pytest.fixture
+    def batch_runner(self, mocker: MockerFixture) -> BatchRunner:
+        mocker.patch("google.cloud.bigquery.Client")
+        mocker.patch(
+            "bqtestmagic.BigQueryTest.read_sql_file",
+            side_effect=lambda sql_file, reliable: f"SELECT * FROM {sql_file.stem}",
+        )
+        return BatchRunner()
+
+    def test_run_one_job_for_each_project_and_labels(
+        self,
+        mocker: MockerFixture,
+        capfd: pytest.CaptureFixture,
+        batch_runner: BatchRunner,
+    ):
+        check = mocker.patch(
+            "bqtestmagic.BigQueryTest.query_to_check_that_pairs_of_query_results_match",  # noqa: E501
+            side_effect=[[True, False], [True]],
+        )
+        batch_runner.add("SELECT 1", Path("a.sql"), None, False, {"k": "v"})
+        batch_runner.add("SELECT 2", Path("b.sql"), None, False, {"k": "v"})
+        batch_runner.add("SELECT 3", Path("c.sql"), "my-project", True, {})
+        batch_runner.run()
+
+        assert check.call_args_list == [
+            mocker.call(
+                [("SELECT * FROM a", "SELECT 1"), ("SELECT * FROM b", "SELECT 2")],
+                {"k": "v"},
+            ),
+            mocker.call([("SELECT * FROM c", "SELECT 3")], {}),
+        ]
+        assert capfd.readouterr() == ("✓ [1] a.sql\n✕ [2] b.sql\n✓ [3] c.sql\n", "")
+
+        batch_runner.run()
+        assert check.call_count == 2
+
+    def test_print_position_in_queue(
+        self,
+        mocker: MockerFixture,
+        capfd: pytest.CaptureFixture,
+        batch_runner: BatchRunner,
+    ):
+        mocker.patch(
+            "bqtestmagic.BigQueryTest.query_to_check_that_pairs_of_query_results_match",  # noqa: E501
+            side_effect=[[True], [False], [True]],
+        )
+        batch_runner.add("SELECT 1", Path("a.sql"), None, False, {"k": "v"})
+        batch_runner.add("SELECT 2", Path("a.sql"), None, False, {})
+        batch_runner.run()
+        batch_runner.add("SELECT 3", Path("a.sql"), None, False, {})
+        batch_runner.run()
+
+        assert capfd.readouterr() == ("✓ [1] a.sql\n✕ [2] a.sql\n✓ [1] a.sql\n", "")
+
+    def test_print_error_if_sql_file_cannot_be_read(
+        self,
+        mocker: MockerFixture,
+        capfd: pytest.CaptureFixture,
+        batch_runner: BatchRunner,
+    ):
+        mocker.patch(
+            "bqtestmagic.BigQueryTest.read_sql_file",
+            side_effect=ValueError("Statement type must be SELECT"),
+        )
+        batch_runner.add("SELECT 1", Path("a.sql"), None, False, {})
+
+        assert batch_runner.tests == {}
+        assert capfd.readouterr() == ("", "ERROR:\nStatement type must be SELECT\n")
+
+    def test_print_error_if_job_fails(
+        self,
+        mocker: MockerFixture,
+        capfd: pytest.CaptureFixture,
+        batch_runner: BatchRunner,
+    ):
+        mocker.patch(
+            "bqtestmagic.BigQueryTest.query_to_check_that_pairs_of_query_results_match",  # noqa: E501
+            side_effect=BadRequest("Syntax error"),
+        )
+        batch_runner.add("SELECT 1", Path("a.sql"), None, False, {})
+        batch_runner.add("SELECT 2", Path("b.sql"), None, False, {})
+        batch_runner.run()
+
+        assert capfd.readouterr() == (
+            "",
+            "ERROR in [1] a.sql, [2] b.sql:\n400 Syntax error\n",
+        )
+        assert batch_runner.tests == {}
+
+
 class TestLabel:
     def test_failed(self):
         with pytest.raises(argparse.ArgumentTypeError):
@@ -104,6 +272,82 @@ class TestLabel:
         assert actual == ("abc", "def")
 
 
+class TestReadSQLFile:
+    def test_cache_until_file_is_modified(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            path = Path(f.name)
+            f.write("SELECT 1")
+            f.flush()
+            os.utime(path, ns=(0, 0))
+            assert _read_sql_file(path, 0, 8) == "SELECT 1"
+
+            f.write(" + 1")
+            f.flush()
+            os.utime(path, ns=(0, 0))
+            assert _read_sql_file(path, 0, 8) == "SELECT 1"
+            assert _read_sql_file(path, 0, 12) == "SELECT 1 + 1"
+            assert _read_sql_file(path, 1, 12) == "SELECT 1 + 1"
+
+    def test_read_file_again_if_size_has_changed(self, mocker: MockerFixture):
+        mocker.patch("google.cloud.bigquery.Client")
+        bigquery_test = BigQueryTest(None)
+        with tempfile.NamedTemporaryFile("w") as f:
+            path = Path(f.name)
+            f.write("SELECT 1")
+            f.flush()
+            os.utime(path, ns=(0, 0))
+            assert bigquery_test.read_sql_file(path, True) == "SELECT 1"
+
+            f.write("0")
+            f.flush()
+            os.utime(path, ns=(0, 0))
+            assert bigquery_test.read_sql_file(path, True) == "SELECT 10"
+
+    def test_read_relative_path_from_working_directory(
+        self, mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch
+    ):
+        mocker.patch("google.cloud.bigquery.Client")
+        bigquery_test = BigQueryTest(None)
+        with tempfile.TemporaryDirectory() as a, tempfile.TemporaryDirectory() as b:
+            for directory, sql in ((a, "SELECT 1"), (b, "SELECT 2")):
+                path = Path(directory, "expected.sql")
+                path.write_text(sql)
+                os.utime(path, ns=(0, 0))
+            monkeypatch.chdir(a)
+            assert bigquery_test.read_sql_file(Path("expected.sql"), True) == "SELECT 1"
+            monkeypatch.chdir(b)
+            assert bigquery_test.read_sql_file(Path("expected.sql"), True) == "SELECT 2"
+
+
+class TestReadCSV:
+    @pytest.mark.parametrize(
+        ("content", "expected"),
+        [
+            ("a,b\n001,2\n", pd.DataFrame({"a": ["001"], "b": [2]})),
+            ("a,b\nx,2\n", pd.DataFrame({"a": ["x"], "b": [2]})),
+        ],
+    )
+    def test_parse_as_dtypes_of_query_results(
+        self, content: str, expected: pd.DataFrame
+    ):
+        like = pd.DataFrame({"a": ["1"], "b": [2]})
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write(content)
+            f.seek(0)
+            actual = _read_csv(Path(f.name), like)
+
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_infer_dtypes_if_file_does_not_match_them(self):
+        like = pd.DataFrame({"a": [1], "b": [2]})
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("a,b\nx,2\n")
+            f.seek(0)
+            actual = _read_csv(Path(f.name), like)
+
+        pd.testing.assert_frame_equal(actual, pd.DataFrame({"a": ["x"], "b": [2]}))
+
+
 class TestBigQueryTest:
     @pytest.fixture
     def bigquery_test(self) -> BigQueryTest:
@@ -130,7 +374,7 @@ class TestBigQueryTest:
                 bigquery_test: BigQueryTest,
             ):
                 df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                run_query = mocker.patch("bqtestmagic.BigQueryTest.run_query")
                 download_query_results_to_dataframe = mocker.patch(
                     "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                     return_value=df,
@@ -139,7 +383,10 @@ class TestBigQueryTest:
                 actual = bigquery_test.test(
                     query=query, csv_file=None, sql_file=None, reliable=False, labels={}
                 )
-                download_query_results_to_dataframe.assert_called_once_with(query, {})
+                run_query.assert_called_once_with(query, {})
+                download_query_results_to_dataframe.assert_called_once_with(
+                    run_query.return_value
+                )
                 pd.testing.assert_frame_equal(actual, df)
                 assert capfd.readouterr() == ("", "")
 
@@ -151,7 +398,7 @@ class TestBigQueryTest:
                     bigquery_test: BigQueryTest,
                 ):
                     df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                    mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                    run_query = mocker.patch("bqtestmagic.BigQueryTest.run_query")
                     download_query_results_to_dataframe = mocker.patch(
                         "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                         return_value=df,
@@ -167,8 +414,9 @@ class TestBigQueryTest:
                             reliable=False,
                             labels={},
                         )
+                    run_query.assert_called_once_with(query, {})
                     download_query_results_to_dataframe.assert_called_once_with(
-                        query, {}
+                        run_query.return_value
                     )
                     pd.testing.assert_frame_equal(actual, df)
                     assert capfd.readouterr() == ("✓\n", "")
@@ -180,7 +428,7 @@ class TestBigQueryTest:
                     bigquery_test: BigQueryTest,
                 ):
                     df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                    mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                    run_query = mocker.patch("bqtestmagic.BigQueryTest.run_query")
                     download_query_results_to_dataframe = mocker.patch(
                         "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                         return_value=df,
@@ -196,8 +444,9 @@ class TestBigQueryTest:
                             reliable=False,
                             labels={},
                         )
+                    run_query.assert_called_once_with(query, {})
                     download_query_results_to_dataframe.assert_called_once_with(
-                        query, {}
+                        run_query.return_value
                     )
                     pd.testing.assert_frame_equal(actual, df)
                     assert capfd.readouterr() == ("✕\n", "")
@@ -208,13 +457,13 @@ class TestBigQueryTest:
                 bigquery_test: BigQueryTest,
             ):
                 df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                mocker.patch("bqtestmagic.BigQueryTest.run_query")
                 mocker.patch(
                     "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                     return_value=df,
                 )
                 mocker.patch(
-                    "bqtestmagic.BigQueryTest.query_to_check_that_two_query_results_match",  # noqa: E501
+                    "bqtestmagic.BigQueryTest.query_to_check_that_query_results_match",  # noqa: E501
                     return_value=False,
                 )
                 validate_query = mocker.patch("bqtestmagic.BigQueryTest.validate_query")
@@ -232,6 +481,45 @@ class TestBigQueryTest:
 
                 validate_query.assert_called_once_with(unreliable_query)
 
+            def test_download_query_results_while_checking_them(
+                self,
+                mocker: MockerFixture,
+                capfd: pytest.CaptureFixture,
+                bigquery_test: BigQueryTest,
+            ):
+                df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
+                checking = threading.Event()
+
+                def download_query_results_to_dataframe(*args):
+                    assert checking.wait(timeout=10)
+                    return df
+
+                def query_to_check_that_query_results_match(*args):
+                    checking.set()
+                    return True
+
+                mocker.patch("bqtestmagic.BigQueryTest.run_query")
+                mocker.patch(
+                    "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
+                    side_effect=download_query_results_to_dataframe,
+                )
+                mocker.patch(
+                    "bqtestmagic.BigQueryTest.query_to_check_that_query_results_match",  # noqa: E501
+                    side_effect=query_to_check_that_query_results_match,
+                )
+                with tempfile.NamedTemporaryFile("w") as f:
+                    f.write("SELECT col1, col1 + 2 col2 FROM UNNEST([1, 2]) col1")
+                    f.seek(0)
+                    actual = bigquery_test.test(
+                        query="SELECT 1 col1, 3 col2 UNION ALL SELECT 2, 4",
+                        csv_file=None,
+                        sql_file=Path(f.name),
+                        reliable=True,
+                        labels={},
+                    )
+                pd.testing.assert_frame_equal(actual, df)
+                assert capfd.readouterr() == ("✓\n", "")
+
             class TestPrintThatTwoQueryResultsAreEqualIfCsvFileIsNotSetAndSqlFileIsSet:
                 def test_success(
                     self,
@@ -240,7 +528,7 @@ class TestBigQueryTest:
                     bigquery_test: BigQueryTest,
                 ):
                     df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                    mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                    run_query = mocker.patch("bqtestmagic.BigQueryTest.run_query")
                     download_query_results_to_dataframe = mocker.patch(
                         "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                         return_value=df,
@@ -250,7 +538,7 @@ class TestBigQueryTest:
                         f.write("SELECT col1, col1 + 2 col2 FROM UNNEST([1, 2]) col1")
                         f.seek(0)
                         mocker.patch(
-                            "bqtestmagic.BigQueryTest.query_to_check_that_two_query_results_match",  # noqa: E501
+                            "bqtestmagic.BigQueryTest.query_to_check_that_query_results_match",  # noqa: E501
                             return_value=True,
                         )
                         actual = bigquery_test.test(
@@ -260,8 +548,10 @@ class TestBigQueryTest:
                             reliable=True,
                             labels={},
                         )
+                    run_query.assert_called_once_with(query, {})
+                    run_query.return_value.result.assert_called_once_with()
                     download_query_results_to_dataframe.assert_called_once_with(
-                        query, {}
+                        run_query.return_value
                     )
                     pd.testing.assert_frame_equal(actual, df)
                     assert capfd.readouterr() == ("✓\n", "")
@@ -273,7 +563,7 @@ class TestBigQueryTest:
                     bigquery_test: BigQueryTest,
                 ):
                     df = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
-                    mocker.patch("google.cloud.bigquery.Client", return_value=None)
+                    run_query = mocker.patch("bqtestmagic.BigQueryTest.run_query")
                     download_query_results_to_dataframe = mocker.patch(
                         "bqtestmagic.BigQueryTest.download_query_results_to_dataframe",
                         return_value=df,
@@ -283,7 +573,7 @@ class TestBigQueryTest:
                         f.write("SELECT col1, col1 + 3 col2 FROM UNNEST([1, 2]) col1")
                         f.seek(0)
                         mocker.patch(
-                            "bqtestmagic.BigQueryTest.query_to_check_that_two_query_results_match",  # noqa: E501
+                            "bqtestmagic.BigQueryTest.query_to_check_that_query_results_match",  # noqa: E501
                             return_value=False,
                         )
                         actual = bigquery_test.test(
@@ -293,8 +583,9 @@ class TestBigQueryTest:
                             reliable=True,
                             labels={},
                         )
+                    run_query.assert_called_once_with(query, {})
                     download_query_results_to_dataframe.assert_called_once_with(
-                        query, {}
+                        run_query.return_value
                     )
                     pd.testing.assert_frame_equal(actual, df)
                     assert capfd.readouterr() == ("✕\n", "")
@@ -306,7 +597,9 @@ class TestBigQueryTest:
     )
     def test_download_query_results_to_dataframe(self, bigquery_test: BigQueryTest):
         actual = bigquery_test.download_query_results_to_dataframe(
-            "SELECT 1 col1, 3 col2 UNION ALL SELECT 2, 4", labels={}
+            bigquery_test.run_query(
+                "SELECT 1 col1, 3 col2 UNION ALL SELECT 2, 4", labels={}
+            )
         )
         expected = pd.DataFrame(data={"col1": [1, 2], "col2": [3, 4]})
         pd.testing.assert_frame_equal(actual, expected)
@@ -315,25 +608,345 @@ class TestBigQueryTest:
         os.environ.get("CI", "false") != "true",
         reason="Unauthenticated tests only",
     )
+    @pytest.mark.parametrize("client_side", [True, False])
     @pytest.mark.parametrize(
         ("left", "right", "expected"),
         [
             ('SELECT NUMERIC "1" a', 'SELECT NUMERIC "1" * 1 a', True),
             ('SELECT NUMERIC "1" a', 'SELECT "1" a', False),
+            ("SELECT 1 a UNION ALL SELECT 1", "SELECT 1 a", False),
+            ("SELECT [1, 2] a, STRUCT(1 AS b) c", "SELECT [1, 2], STRUCT(1)", True),
         ],
     )
-    def test_query_to_check_that_two_query_results_match(
+    def test_query_to_check_that_query_results_match(
         self,
+        mocker: MockerFixture,
         bigquery_test: BigQueryTest,
+        client_side: bool,
         left: str,
         right: str,
         expected: bool,
     ):
-        actual = bigquery_test.query_to_check_that_two_query_results_match(
-            left, right, {}
+        if not client_side:
+            mocker.patch("bqtestmagic._CLIENT_SIDE_COMPARISON_MAX_BYTES", 0)
+        query_job = bigquery_test.run_query(right, {})
+        actual = bigquery_test.query_to_check_that_query_results_match(
+            left, query_job, query_job.result(), {}
         )
         assert actual == expected
 
+    @pytest.mark.skipif(
+        os.environ.get("CI", "false") != "true",
+        reason="Unauthenticated tests only",
+    )
+    def test_query_to_check_that_pairs_of_query_results_match_in_bigquery(
+        self, bigquery_test: BigQueryTest
+    ):
+        actual = bigquery_test.query_to_check_that_pairs_of_query_results_match(
+            [
+                ('SELECT NUMERIC "1" a', 'SELECT NUMERIC "1" * 1 a'),
+                ('SELECT NUMERIC "1" a', 'SELECT "1" a'),
+            ],
+            {},
+        )
+        assert actual == [True, False]
+
+    class TestQueryToSelectQueryResults:
+        def test_select_from_destination_table(self, mocker: MockerFixture):
+            query_job = mocker.Mock()
+            query_job.destination = TableReference.from_string(
+                "my-project._abc.anon123"
+            )
+            mocker.patch("google.cloud.bigquery.Client")
+            actual = BigQueryTest(None).query_to_select_query_results(query_job)
+
+            query_job.result.assert_not_called()
+            assert actual == "SELECT * FROM `my-project._abc.anon123`"
+
+        def test_query_itself_if_there_is_no_destination_table(
+            self, mocker: MockerFixture
+        ):
+            query_job = mocker.Mock(destination=None, query="SELECT 1; SELECT 2;")
+            mocker.patch("google.cloud.bigquery.Client")
+            actual = BigQueryTest(None).query_to_select_query_results(query_job)
+
+            assert actual == "SELECT 1; SELECT 2;"
+
+    class TestQueryToCheckThatQueryResultsMatch:
+        @pytest.fixture
+        def client(self, mocker: MockerFixture):
+            return mocker.patch("google.cloud.bigquery.Client").return_value
+
+        @pytest.fixture
+        def bigquery_test(self, client) -> BigQueryTest:
+            return BigQueryTest(None)
+
+        @pytest.fixture
+        def query_job(self, mocker: MockerFixture):
+            return mocker.Mock(
+                destination=TableReference.from_string("my-project._abc.anon123")
+            )
+
+        @pytest.mark.parametrize(
+            ("expected_rows", "actual_rows", "expected"),
+            [
+                (Counter({(1,): 2}), Counter({(1,): 2}), True),
+                (Counter({(1,): 2}), Counter({(1,): 1}), False),
+            ],
+        )
+        def test_compare_locally_if_results_are_small(
+            self,
+            mocker: MockerFixture,
+            client,
+            bigquery_test: BigQueryTest,
+            query_job,
+            expected_rows: Counter,
+            actual_rows: Counter,
+            expected: bool,
+        ):
+            mocker.patch("bqtestmagic.BigQueryTest.dry_run", return_value=("SELECT", 0))
+            run_query_and_wait = mocker.patch(
+                "bqtestmagic.BigQueryTest.run_query_and_wait"
+            )
+            count_rows = mocker.patch(
+                "bqtestmagic._count_rows", side_effect=[expected_rows, actual_rows]
+            )
+            assert_that_two_query_results_match = mocker.patch(
+                "bqtestmagic.BigQueryTest.assert_that_two_query_results_match"
+            )
+            results = mocker.Mock(total_rows=3)
+            actual = bigquery_test.query_to_check_that_query_results_match(
+                "SELECT 1", query_job, results, {}
+            )
+
+            assert actual is expected
+            run_query_and_wait.assert_called_once_with(
+                "SELECT 1", {}, max_results=10001
+            )
+            assert count_rows.call_args_list == [
+                mocker.call(run_query_and_wait.return_value),
+                mocker.call(results),
+            ]
+            client.query.assert_not_called()
+            assert_that_two_query_results_match.assert_not_called()
+
+        @pytest.mark.parametrize(
+            ("destination", "total_rows", "bytes_processed", "expected_rows"),
+            [
+                (None, None, 0, Counter()),
+                ("my-project._abc.anon123", 10001, 0, Counter()),
+                ("my-project._abc.anon123", 3, 10 * 1024 * 1024, Counter()),
+                ("my-project._abc.anon123", 3, 0, None),
+            ],
+        )
+        def test_assert_in_bigquery_if_results_are_large(
+            self,
+            mocker: MockerFixture,
+            bigquery_test: BigQueryTest,
+            destination: Optional[str],
+            total_rows: Optional[int],
+            bytes_processed: int,
+            expected_rows: Optional[Counter],
+        ):
+            mocker.patch(
+                "bqtestmagic.BigQueryTest.dry_run",
+                return_value=("SELECT", bytes_processed),
+            )
+            mocker.patch("bqtestmagic.BigQueryTest.run_query_and_wait")
+            mocker.patch("bqtestmagic._count_rows", return_value=expected_rows)
+            assert_that_two_query_results_match = mocker.patch(
+                "bqtestmagic.BigQueryTest.assert_that_two_query_results_match",
+                return_value=True,
+            )
+            query_job = mocker.Mock(
+                destination=destination and TableReference.from_string(destination),
+                query="SELECT 2",
+            )
+            actual = bigquery_test.query_to_check_that_query_results_match(
+                "SELECT 1", query_job, mocker.Mock(total_rows=total_rows), {}
+            )
+
+            assert actual is True
+            assert_that_two_query_results_match.assert_called_once_with(
+                "SELECT 1",
+                bigquery_test.query_to_select_query_results(query_job),
+                {},
+            )
+
+    class TestCountRows:
+        @staticmethod
+        def row_iterator(mocker: MockerFixture, schema: List[SchemaField], rows):
+            row_iterator = mocker.MagicMock(schema=schema)
+            field_to_index = {field.name: i for i, field in enumerate(schema)}
+            row_iterator.__iter__.return_value = iter(
+                [Row(values, field_to_index) for values in rows]
+            )
+            return row_iterator
+
+        @pytest.mark.parametrize(
+            ("left", "right", "expected"),
+            [
+                (
+                    ([SchemaField("a", "INTEGER", mode="REPEATED")], ([1, 2],)),
+                    ([SchemaField("b", "INTEGER", mode="REPEATED")], ([1, 2],)),
+                    True,
+                ),
+                (
+                    (
+                        [
+                            SchemaField(
+                                "c", "RECORD", fields=[SchemaField("b", "INTEGER")]
+                            )
+                        ],
+                        ({"b": 1},),
+                    ),
+                    (
+                        [
+                            SchemaField(
+                                "c",
+                                "RECORD",
+                                fields=[SchemaField("_field_1", "INTEGER")],
+                            )
+                        ],
+                        ({"_field_1": 1},),
+                    ),
+                    True,
+                ),
+                (
+                    ([SchemaField("a", "NUMERIC")], (Decimal("1"),)),
+                    ([SchemaField("a", "BIGNUMERIC")], (Decimal("1"),)),
+                    False,
+                ),
+                (
+                    ([SchemaField("a", "GEOGRAPHY")], ("POINT(1 1)",)),
+                    ([SchemaField("a", "STRING")], ("POINT(1 1)",)),
+                    False,
+                ),
+                (
+                    ([SchemaField("a", "INTEGER")], (None,)),
+                    ([SchemaField("a", "STRING")], (None,)),
+                    True,
+                ),
+            ],
+        )
+        def test_count_rows_as_format_t_does(
+            self,
+            mocker: MockerFixture,
+            left: Tuple[List[SchemaField], tuple],
+            right: Tuple[List[SchemaField], tuple],
+            expected: bool,
+        ):
+            left_rows = _count_rows(self.row_iterator(mocker, left[0], [left[1]]))
+            right_rows = _count_rows(self.row_iterator(mocker, right[0], [right[1]]))
+
+            assert (left_rows == right_rows) is expected
+
+        def test_none_if_there_are_too_many_rows(self, mocker: MockerFixture):
+            mocker.patch("bqtestmagic._CLIENT_SIDE_COMPARISON_MAX_ROWS", 1)
+            schema = [SchemaField("a", "INTEGER")]
+
+            assert _count_rows(self.row_iterator(mocker, schema, [(1,)])) == Counter(
+                {(("INTEGER", "1"),): 1}
+            )
+            assert _count_rows(self.row_iterator(mocker, schema, [(1,), (1,)])) is None
+
+    def test_query_to_check_that_pairs_of_query_results_match(
+        self, mocker: MockerFixture
+    ):
+        mocker.patch("google.cloud.bigquery.Client")
+        run_query_and_wait = mocker.patch(
+            "bqtestmagic.BigQueryTest.run_query_and_wait",
+            return_value=[{"i": 1, "equals": False}, {"i": 0, "equals": True}],
+        )
+        actual = BigQueryTest(None).query_to_check_that_pairs_of_query_results_match(
+            [("SELECT '''a\n\nb'''", "SELECT 1"), ("SELECT 1", "SELECT 2")],
+            {"k": "v"},
+        )
+
+        assert actual == [True, False]
+        sql, labels = run_query_and_wait.call_args[0]
+        assert sql.count("UNION ALL") == 1
+        assert "FROM (\nSELECT '''a\n\nb'''\n    ) AS actual" in sql
+        assert labels == {"k": "v"}
+
+    def test_assert_that_two_query_results_match_every_time(
+        self, mocker: MockerFixture
+    ):
+        client = mocker.patch("google.cloud.bigquery.Client").return_value
+        bigquery_test = BigQueryTest(None)
+        for _ in range(2):
+            assert bigquery_test.assert_that_two_query_results_match(
+                "SELECT 1", "SELECT 1", {}
+            )
+
+        assert client.query.call_count == 2
+        assert bqtestmagic._match_sql.cache_info().hits == 1
+
+    def test_embed_queries_as_they_are(self):
+        sql = bqtestmagic._match_sql(
+            "SELECT '''a\n\nb''' -- comment\n", "SELECT 'a'"
+        )
+
+        assert "FROM (\nSELECT '''a\n\nb''' -- comment\n    ) AS actual" in sql
+        assert "FROM (\nSELECT 'a'\n    ) AS expected" in sql
+
+    class TestRunQueryAndWait:
+        def test_run_query_and_wait_in_one_request(self, mocker: MockerFixture):
+            client = mocker.patch("google.cloud.bigquery.Client").return_value
+            actual = BigQueryTest(None).run_query_and_wait(
+                "SELECT 1", {"k": "v"}, max_results=1
+            )
+
+            assert actual is client.query_and_wait.return_value
+            client.query_and_wait.assert_called_once_with(
+                "SELECT 1", job_config=mocker.ANY, max_results=1
+            )
+            assert client.query_and_wait.call_args[1]["job_config"].labels == {"k": "v"}
+            client.query.assert_not_called()
+
+        def test_wait_for_job_if_client_does_not_have_query_and_wait(
+            self, mocker: MockerFixture
+        ):
+            client = mocker.Mock(spec=["query"])
+            mocker.patch("google.cloud.bigquery.Client", return_value=client)
+            actual = BigQueryTest(None).run_query_and_wait("SELECT 1", {})
+
+            assert actual is client.query.return_value.result.return_value
+            client.query.return_value.result.assert_called_once_with(max_results=None)
+
+    class TestValidateQueryCache:
+        def test_skip_dry_run_if_query_has_been_validated(self, mocker: MockerFixture):
+            client = mocker.patch("google.cloud.bigquery.Client").return_value
+            client.query.return_value.statement_type = "SELECT"
+            BigQueryTest(None).validate_query("SELECT 1")
+            BigQueryTest(None).validate_query("SELECT 1")
+            BigQueryTest(None).validate_query("SELECT 2")
+
+            assert [c[0][0] for c in client.query.call_args_list] == [
+                "SELECT 1",
+                "SELECT 2",
+            ]
+
+        def test_reuse_validation_dry_run(self, mocker: MockerFixture):
+            client = mocker.patch("google.cloud.bigquery.Client").return_value
+            client.query.return_value.statement_type = "SELECT"
+            client.query.return_value.total_bytes_processed = 10
+            BigQueryTest(None).validate_query("SELECT 1")
+
+            assert BigQueryTest(None).dry_run("SELECT 1") == ("SELECT", 10)
+            assert client.query.call_count == 1
+
+        def test_dry_run_again_if_query_has_failed_validation(
+            self, mocker: MockerFixture
+        ):
+            client = mocker.patch("google.cloud.bigquery.Client").return_value
+            client.query.return_value.statement_type = "SCRIPT"
+            for _ in range(2):
+                with pytest.raises(ValueError):
+                    BigQueryTest(None).validate_query("SELECT 1; SELECT 2;")
+
+            assert client.query.call_count == 2
+
     @pytest.mark.skipif(
         os.environ.get("CI", "false") != "true",
         reason="Unauthenticated tests only",